@@ -1,9 +1,12 @@
 import os
 import json
+import mmap
 import random
 import glob
-import regex
+import tempfile
+import functools
 from collections import OrderedDict
+from typing import List, Sequence
 
 import numpy as np
 import torch
@@ -16,7 +19,7 @@ from tokenizer import (
     char_tokenizer, word_tokenizer,
     num_max_word, num_max_char
 )
-from utils.common import SpecialTokens, all_special_tokens
+from utils.common import SpecialTokens, special_token_set
 
 
 def get_key(item):
@@ -24,68 +27,175 @@ def get_key(item):
     return int(item.rsplit('.', 1)[0].rsplit('_', 1)[1])
 
 
-def custom_collator(batch):
+def build_line_offsets(fpath: str) -> np.ndarray:
+    """
+    Scan a corpus file once and record the byte offset at which every line starts
+    """
+    offsets = [0]
+    with open(fpath, "rb") as fp:
+        for _ in iter(fp.readline, b""):
+            offsets.append(fp.tell())
+    # The last offset points to EOF, not to a line
+    return np.asarray(offsets[:-1], dtype=np.int64)
+
+
+def read_offsets_cache(cache_file: str) -> dict:
+    """
+    Read {file name: ((mtime_ns, size), offsets)} from an .npz written by write_offsets_cache.
+    The corpus directory may be shared, so the cache is loaded without pickle, and anything missing,
+    corrupt or of an unexpected layout is treated as an empty cache
+    """
+    try:
+        with np.load(cache_file, allow_pickle=False) as npz:
+            names = npz["names"]
+            signatures = npz["signatures"]
+            if names.ndim != 1 or signatures.shape != (len(names), 2) or signatures.dtype != np.int64:
+                return {}
+            cache = {}
+            for idx, (name, signature) in enumerate(zip(names.tolist(), signatures.tolist())):
+                offsets = npz[f"offsets_{idx}"]
+                if not isinstance(name, str) or offsets.ndim != 1 or offsets.dtype != np.int64:
+                    return {}
+                cache[name] = (tuple(signature), offsets)
+            return cache
+    except Exception:
+        return {}
+
+
+def write_offsets_cache(cache: dict, cache_file: str):
+    """
+    Write the cache to a temp file and rename it, so an interrupted or concurrent write never leaves
+    a truncated cache. Failing to write (e.g. read-only corpus directory) is ignored
+    """
+    names = list(cache)
+    arrays = {f"offsets_{idx}": cache[name][1] for idx, name in enumerate(names)}
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                np.savez(fp, names=np.array(names, dtype=str),
+                         signatures=np.array([cache[name][0] for name in names], dtype=np.int64).reshape(-1, 2),
+                         **arrays)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+    except OSError:
+        pass
+
+
+def load_line_offsets(corpus_files: Sequence[str], cache_file: str) -> List[np.ndarray]:
+    """
+    Load per-file line offsets from cache_file, rebuild the ones whose file changed (mtime or size)
+    """
+    cache = read_offsets_cache(cache_file)
+
+    offsets = []
+    updated = False
+    for fpath in corpus_files:
+        stat = os.stat(fpath)
+        key = os.path.basename(fpath)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if key not in cache or cache[key][0] != signature:
+            cache[key] = (signature, build_line_offsets(fpath))
+            updated = True
+        offsets.append(cache[key][1])
+
+    if updated:
+        write_offsets_cache(cache, cache_file)
+    return offsets
+
+
+@functools.lru_cache(maxsize=200_000)
+def encode_chars(word: str) -> np.ndarray:
+    """
+    Char ids of a word, including [CLS] and [SEP] but not padded.
+    Cached, since word frequencies are heavy-tailed and the same words recur across batches
+    """
+    # Chars are already split, skip the join and the whitespace pre-tokenizer pass
+    char_ids = char_tokenizer(pre_char_tokenizer.pre_tokenize(word), is_split_into_words=True,
+                              truncation=True, max_length=num_max_char)["input_ids"]
+    return np.asarray(char_ids, dtype=np.int16)
+
+
+def custom_collator(batch, static_padding: bool = False):
     """
     Collator for misspelled dataset
     Args:
         batch: list[tuple(success, origin_tokens, synth_tokens, onehot_labels)]
+        static_padding: pad words to num_max_word and chars to num_max_char instead of the longest in batch,
+                        so every batch has the same shapes (e.g. for torch.compile or CUDA graphs)
     Returns:
         Dict {
             "word_input_ids": torch.LongTensor of shape batch x word_seq_length
             "word_attention_mask": torch.LongTensor of shape batch x word_seq_length
-            "word_token_type_ids": torch.LongTensor of shape batch x word_seq_length
             "char_input_ids": torch.LongTensor of shape (batch x word_seq_length) x char_sequence_length
             "char_attention_mask": torch.LongTensor of shape (batch x word_seq_length) x char_sequence_length
-            "char_token_type_ids": torch.LongTensor of shape (batch x word_seq_length) x char_sequence_length
             "correction_labels": torch.LongTensor of shape batch x word_seq_length
             "detection_labels": torch.LongTensor of shape batch x word_seq_length
         }
+        Token type ids are not returned: inputs are single sentences, so they are all zeros,
+        and the model creates them on its device when missing
     """
     _, batch_origin_tokens, batch_synth_tokens, batch_onehot_labels = zip(*batch)
 
     # Pad batch_onehot_labels to shape B x Seq Len
-    max_length = 0
-    max_idx = 0
-    # +2 accounts for [CLS] and [SEP]
-    for idx, item in enumerate(batch_onehot_labels):
-        if len(item) + 2 > max_length:
-            max_length = len(item) + 2
-            max_idx = idx
+    max_idx = max(range(len(batch_onehot_labels)), key=lambda idx: len(batch_onehot_labels[idx]))
+    # +2 accounts for [CLS] and [SEP], truncate to maximum number of words
+    max_length = num_max_word if static_padding else min(len(batch_onehot_labels[max_idx]) + 2, num_max_word)
 
-    batch_detection_lbs = [[0] + item + [0] * (max_length - len(item) - 1) for item in batch_onehot_labels]
-    # Truncate to maximum number of words
-    batch_detection_lbs = [item[:num_max_word] for item in batch_detection_lbs]
-    batch_detection_lbs = torch.LongTensor(batch_detection_lbs)
+    # Fill a numpy buffer (list to array conversion is done in C), then share its memory with torch
+    batch_detection_lbs = np.zeros((len(batch_onehot_labels), max_length), dtype=np.int64)
+    for idx, item in enumerate(batch_onehot_labels):
+        item = item[:max_length - 2]
+        batch_detection_lbs[idx, 1:1 + len(item)] = item
+    batch_detection_lbs = torch.from_numpy(batch_detection_lbs)
 
     # Word/Char encoding
     batch_origin_tokens = [' '.join(tks) for tks in batch_origin_tokens]
     batch_synth_tokens = [' '.join(tks) for tks in batch_synth_tokens]
 
-    # input_ids, token_type_ids, attention_mask
-    batch_synth_enc = word_tokenizer(batch_synth_tokens, padding=True, truncation=True,
-                                     max_length=num_max_word, return_tensors="pt")
-
-    batch_origin_enc = word_tokenizer(batch_origin_tokens, padding=True, truncation=True,
-                                      max_length=num_max_word, return_tensors="pt")
+    # input_ids, attention_mask
+    # Encode both in a single call, then split back. Synthesized and original sentences have the same
+    # number of words, so padding to the longest of both halves does not change the shapes
+    batch_size = len(batch_synth_tokens)
+    batch_enc = word_tokenizer(batch_synth_tokens + batch_origin_tokens,
+                               padding="max_length" if static_padding else True, truncation=True,
+                               max_length=num_max_word, return_token_type_ids=False, return_tensors="pt")
+    batch_synth_enc = {key: value[:batch_size] for key, value in batch_enc.items()}
+    batch_origin_enc = {key: value[batch_size:] for key, value in batch_enc.items()}
     batch_correction_lbs = batch_origin_enc["input_ids"]
 
     # Create batch of char ids = batch(sent 1) "stack on" batch(sent 2)
+    # Words are taken from the text, not from the ids, since out-of-vocab words are [UNK] there.
+    # [CLS], [SEP], [PAD] positions are known from the attention mask and are all mapped to [UNK]
     batch_sent_words = []
 
     _, seq_word_len = batch_synth_enc["input_ids"].shape
-    for sent_idx, synth_tokens in enumerate(batch_synth_tokens):
-        synth_tokens = synth_tokens.split()
-        synth_tokens = [SpecialTokens.cls] + synth_tokens[:seq_word_len - 2] + [SpecialTokens.sep]
-        synth_tokens = synth_tokens + [SpecialTokens.pad] * (seq_word_len - len(synth_tokens))
-        for word_idx, word in enumerate(synth_tokens):
-            if word in all_special_tokens:
-                batch_sent_words.append(SpecialTokens.unk)
-            else:
-                batch_sent_words.append(word)
-
-    batch_char_tok = [' '.join(pre_char_tokenizer.pre_tokenize(word)) for word in batch_sent_words]
-    batch_char_enc = char_tokenizer(batch_char_tok, padding=True, truncation=True,
-                                    max_length=num_max_char, return_tensors="pt")
+    batch_num_words = (batch_synth_enc["attention_mask"].sum(dim=1) - 2).tolist()
+    for synth_tokens, num_words in zip(batch_synth_tokens, batch_num_words):
+        words = [SpecialTokens.unk if word in special_token_set else word
+                 for word in synth_tokens.split()[:num_words]]
+        batch_sent_words += [SpecialTokens.unk] + words + [SpecialTokens.unk] * (seq_word_len - num_words - 1)
+
+    # Words repeat a lot within a batch (incl. [UNK] for every special position):
+    # encode each distinct word once, then gather back to every position
+    uniq_words = {}
+    inverse_idx = torch.as_tensor([uniq_words.setdefault(word, len(uniq_words)) for word in batch_sent_words])
+
+    uniq_char_ids = [encode_chars(word) for word in uniq_words]
+    uniq_lengths = torch.as_tensor([len(char_ids) for char_ids in uniq_char_ids])
+    seq_char_len = num_max_char if static_padding else int(uniq_lengths.max())
+    uniq_input_ids = np.full((len(uniq_char_ids), seq_char_len), char_tokenizer.pad_token_id, dtype=np.int64)
+    for idx, char_ids in enumerate(uniq_char_ids):
+        uniq_input_ids[idx, :len(char_ids)] = char_ids
+    uniq_input_ids = torch.from_numpy(uniq_input_ids)
+    uniq_attention_mask = (torch.arange(uniq_input_ids.size(1)) < uniq_lengths[:, None]).long()
+
+    batch_char_enc = {
+        "input_ids": uniq_input_ids[inverse_idx],
+        "attention_mask": uniq_attention_mask[inverse_idx]
+    }
 
     assert (batch_char_enc["input_ids"].size(0) / len(batch_origin_tokens) == batch_synth_enc["input_ids"].size(1)), \
         f'ERROR {batch_char_enc["input_ids"].size(0)} {len(batch_origin_tokens)} {batch_synth_enc["input_ids"].size(1)}'
@@ -94,7 +204,7 @@ def custom_collator(batch):
         f'{batch_origin_tokens[max_idx]}\n' \
         f'{batch_synth_tokens[max_idx]}'
 
-    batch_detection_lbs[batch_detection_lbs != 0] = 1
+    batch_detection_lbs.clamp_(max=1)
 
     # Mark label of PADDING position to be -100, so this will not contribute to detection loss
     padding_mask = batch_synth_enc["attention_mask"].type(torch.bool)
@@ -103,10 +213,8 @@ def custom_collator(batch):
     return {
         "word_input_ids": batch_synth_enc["input_ids"],
         "word_attention_mask": batch_synth_enc["attention_mask"],
-        "word_token_type_ids": batch_synth_enc["token_type_ids"],
         "char_input_ids": batch_char_enc["input_ids"],
         "char_attention_mask": batch_char_enc["attention_mask"],
-        "char_token_type_ids": batch_char_enc["token_type_ids"],
         "correction_labels": batch_correction_lbs,
         "detection_labels": batch_detection_lbs
     }
@@ -116,6 +224,10 @@ class MisspelledDataset(Dataset):
     """
     Create a synthesized misspelled dataset
     """
+    # Maximum number of corpus files kept mapped per worker
+    max_open_files = 16
+    # Maximum number of lines sampled in __getitem__ before giving up
+    max_sample_retries = 100
 
     def __init__(self,
                  corpus_dir: str,
@@ -141,58 +253,95 @@ class MisspelledDataset(Dataset):
         self.num_lines = self.stats["total_lines"]
         self.num_files = self.stats["num_files"]
 
-        self.corpus_files = glob.glob(os.path.join(self.corpus_dir, "corpus_*.txt"))
-        self.corpus_files = sorted(self.corpus_files, key=lambda x: get_key(x))
+        corpus_files = glob.glob(os.path.join(self.corpus_dir, "corpus_*.txt"))
+        self.corpus_files = tuple(sorted(corpus_files, key=lambda x: get_key(x)))
         self.synthesizer = Synthesizer()
-        self.file_size = OrderedDict()
 
-        for idx in range(self.num_files):
-            if idx != self.num_files - 1:
-                self.file_size[idx] = self.lines_per_file
-            else:
-                remainder = self.num_lines % self.lines_per_file
-                self.file_size[idx] = remainder if remainder > 0 else self.lines_per_file
+        # Byte offset of every line, so a line can be read without scanning the file
+        self.offsets = load_line_offsets(self.corpus_files, os.path.join(corpus_dir, "line_offsets.npz"))
+        # Number of lines of each file, taken from the files themselves in case stats.json is out of date
+        self.file_size = np.array([len(file_offsets) for file_offsets in self.offsets], dtype=np.int64)
+        # Mapped lazily in each worker, see get_mmap()
+        self._mmaps = OrderedDict()
+
+    def __getstate__(self):
+        # Memory maps cannot be pickled (e.g. DataLoader with spawn start method)
+        state = self.__dict__.copy()
+        state["_mmaps"] = OrderedDict()
+        return state
+
+    def __del__(self):
+        for mm in getattr(self, "_mmaps", {}).values():
+            mm.close()
+
+    def get_mmap(self, file_idx: int) -> mmap.mmap:
+        """
+        Return a read-only memory map of corpus_files[file_idx], keep at most max_open_files mapped.
+        Pages are shared through the OS page cache by all workers, and maps have no file position,
+        so maps inherited by forked workers are safe to use
+        """
+        mm = self._mmaps.get(file_idx)
+        if mm is not None:
+            self._mmaps.move_to_end(file_idx)
+            return mm
+
+        if len(self._mmaps) >= self.max_open_files:
+            _, oldest_mm = self._mmaps.popitem(last=False)
+            oldest_mm.close()
+        with open(self.corpus_files[file_idx], "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps[file_idx] = mm
+        return mm
 
     def __len__(self):
         return self.num_lines
 
     def __getitem__(self, index):
-        # Simply random file, then random line
-        file_idx = random.randint(0, len(self.corpus_files) - 1)
-        line_idx = random.randint(0, self.file_size[file_idx] - 1)
+        # Index is ignored, we sample a random line instead. Lines that cannot be used are resampled
+        for _ in range(self.max_sample_retries):
+            # Simply random file, then random line
+            file_idx = random.randint(0, len(self.corpus_files) - 1)
+            if self.file_size[file_idx] == 0:
+                continue
+            line_idx = random.randint(0, int(self.file_size[file_idx]) - 1)
+
+            mm = self.get_mmap(file_idx)
+            line_start = int(self.offsets[file_idx][line_idx])
+            line_end = mm.find(b"\n", line_start)
+            raw_line = mm[line_start:line_end if line_end >= 0 else len(mm)].strip()
+            if not raw_line:
+                # Random and get another sentence, without paying for decoding
+                continue
+
+            # Decode only lines we keep, a broken byte should not kill the worker
+            line = raw_line.decode("utf-8", errors="ignore")
 
-        with open(self.corpus_files[file_idx]) as fp:
-            for count, line in enumerate(fp):
-                if count == line_idx:
-                    break
+            # Assume corpus is already preprocessed
+            # line = line.replace('\u200b', '')  # Work around for [​] char
+            # line = pattern.sub("", line).strip()
+            # line = remove_emoji(line)
 
-        # Assume corpus is already preprocessed
-        # line = line.replace('\u200b', '')  # Work around for [​] char
-        # line = pattern.sub("", line).strip()
-        # line = remove_emoji(line)
-        if not line:
-            # Random and get another sentence
-            return self.__getitem__(123)
+            origin_tokens = self.pre_word_tokenizer.pre_tokenize(line)
+            if len(origin_tokens) < self.min_num_tokens:
+                # If the sentence is too short, skip
+                continue
 
-        origin_tokens = self.pre_word_tokenizer.pre_tokenize(line)
-        if len(origin_tokens) < self.min_num_tokens:
-            # If the sentence is too short, skip
-            return self.__getitem__(123)
+            # Randomly chunk <num_max_word> of a lengthy text
+            if len(origin_tokens) > num_max_word:
+                start = random.randint(0, len(origin_tokens) - num_max_word - 1)
+                origin_tokens = origin_tokens[start: start + num_max_word]
 
-        # Randomly chunk <num_max_word> of a lengthy text
-        if len(origin_tokens) > num_max_word:
-            start = random.randint(0, len(origin_tokens) - num_max_word - 1)
-            origin_tokens = origin_tokens[start: start + num_max_word]
+            success, origin_tokens, tokens, onehot_label = self.synthesizer.add_noise(
+                origin_tokens=origin_tokens, percent_err=self.percent_err)
 
-        success, origin_tokens, tokens, onehot_label = self.synthesizer.add_noise(
-            origin_tokens=origin_tokens, percent_err=self.percent_err)
+            if not success:
+                # If failed to add noise like case origin_tokens = ["35", "."]
+                # We get another sample
+                continue
 
-        if not success:
-            # If failed to add noise like case origin_tokens = ["35", "."]
-            # We get another sample
-            return self.__getitem__(123)
+            return success, origin_tokens, tokens, onehot_label
 
-        return success, origin_tokens, tokens, onehot_label
+        raise RuntimeError(f"No usable sentence found in {self.corpus_dir} after {self.max_sample_retries} samples")
 
 
 if __name__ == '__main__':
@@ -201,7 +350,8 @@ if __name__ == '__main__':
 
     # ds = MisspelledDataset(corpus_dir="/home/local/BM/Datasets/SpellNews")
     # print(ds[123])
-    # loader = DataLoader(ds, batch_size=2, collate_fn=custom_collator, drop_last=True)
+    # loader = DataLoader(ds, batch_size=2, collate_fn=custom_collator, drop_last=True, num_workers=2,
+    #                     persistent_workers=True, pin_memory=True, prefetch_factor=2)
     #
     # for sample in tqdm(loader, total=len(ds)//2):
     #     pass
@@ -2,6 +2,7 @@ import json
 import re
 from typing import List, Dict
 
+import numpy as np
 import torch
 from tokenizers.normalizers import NFKC, Lowercase, Sequence
 from torch.utils.data import Dataset, DataLoader
@@ -11,7 +12,7 @@ from tokenizer import (
     pre_char_tokenizer, char_tokenizer,
     num_max_char, num_max_word
 )
-from utils.common import tokenize_with_span, SpecialTokens, all_special_tokens
+from utils.common import tokenize_with_span, SpecialTokens, special_token_set
 
 
 def check_file(fpath):
@@ -85,33 +86,33 @@ def prepare_data(fpath):
 def wiki_spelling_collator(batch):
     batch_origin_tokens, batch_detection_labels, batch_subs = zip(*batch)
 
-    batch_detection_lbs = [[0] + item + [0] * (num_max_word - len(item) - 1) for item in batch_detection_labels]
-    # Truncate to maximum number of words
-    batch_detection_lbs = [item[:num_max_word] for item in batch_detection_lbs]
-    batch_detection_lbs = torch.LongTensor(batch_detection_lbs)
-    batch_detection_lbs[batch_detection_lbs != 0] = 1
+    batch_detection_lbs = np.zeros((len(batch_detection_labels), num_max_word), dtype=np.int64)
+    for idx, item in enumerate(batch_detection_labels):
+        # Truncate to maximum number of words, [CLS] and [SEP] positions stay 0
+        item = item[:num_max_word - 2]
+        batch_detection_lbs[idx, 1:1 + len(item)] = item
+    batch_detection_lbs = torch.from_numpy(batch_detection_lbs)
+    batch_detection_lbs.clamp_(max=1)
 
     batch_origin_tokens = [' '.join(tks) for tks in batch_origin_tokens]
     # Pad to max position embedding
     batch_origin_enc = word_tokenizer(batch_origin_tokens, padding=True, truncation=True,
-                                      max_length=num_max_word, return_tensors="pt")
+                                      max_length=num_max_word, return_token_type_ids=False, return_tensors="pt")
     # Create batch of char ids = batch(sent 1) "stack on" batch(sent 2)
+    # Words are taken from the text, not from the ids, since out-of-vocab words are [UNK] there.
+    # [CLS], [SEP], [PAD] positions are known from the attention mask and are all mapped to [UNK]
     batch_sent_words = []
 
     _, seq_word_len = batch_origin_enc["input_ids"].shape
-    for sent_idx, tokens in enumerate(batch_origin_tokens):
-        tokens = tokens.split()
-        tokens = [SpecialTokens.cls] + tokens[:seq_word_len - 2] + [SpecialTokens.sep]
-        tokens = tokens + [SpecialTokens.pad] * (seq_word_len - len(tokens))
-        for word_idx, word in enumerate(tokens):
-            if word in all_special_tokens:
-                batch_sent_words.append(SpecialTokens.unk)
-            else:
-                batch_sent_words.append(word)
+    batch_num_words = (batch_origin_enc["attention_mask"].sum(dim=1) - 2).tolist()
+    for tokens, num_words in zip(batch_origin_tokens, batch_num_words):
+        words = [SpecialTokens.unk if word in special_token_set else word
+                 for word in tokens.split()[:num_words]]
+        batch_sent_words += [SpecialTokens.unk] + words + [SpecialTokens.unk] * (seq_word_len - num_words - 1)
 
     batch_char_tok = [' '.join(pre_char_tokenizer.pre_tokenize(word)) for word in batch_sent_words]
     batch_char_enc = char_tokenizer(batch_char_tok, padding=True, truncation=True,
-                                    max_length=num_max_char, return_tensors="pt")
+                                    max_length=num_max_char, return_token_type_ids=False, return_tensors="pt")
     assert (batch_char_enc["input_ids"].size(0) / len(batch_origin_tokens) == batch_origin_enc["input_ids"].size(1)), \
         f'ERROR {batch_char_enc["input_ids"].size(0)} {len(batch_origin_tokens)} {batch_origin_enc["input_ids"].size(1)}'
     assert (batch_origin_enc["input_ids"].size() == batch_detection_lbs.size()), \
@@ -124,10 +125,8 @@ def wiki_spelling_collator(batch):
     return {
         "word_input_ids": batch_origin_enc["input_ids"],
         "word_attention_mask": batch_origin_enc["attention_mask"],
-        "word_token_type_ids": batch_origin_enc["token_type_ids"],
         "char_input_ids": batch_char_enc["input_ids"],
         "char_attention_mask": batch_char_enc["attention_mask"],
-        "char_token_type_ids": batch_char_enc["token_type_ids"],
         "correction_labels": batch_subs,
         "origin_sequences": [seq.split() for seq in batch_origin_tokens],
         "detection_labels": batch_detection_lbs,
@@ -1,3 +1,4 @@
+from functools import partial
 from typing import Any
 
 import torch
@@ -173,15 +174,22 @@ def main():
     # Define training config
     params = Param()
 
+    # Keep workers (and their per-word caches) alive across epochs, pin batches for faster host to GPU copy.
+    # Prefetching stays conservative since char tensors of a batch are large
+    loader_kwargs = {"num_workers": params.NUM_WORKER, "pin_memory": True}
+    if params.NUM_WORKER > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
+
     # Define dataset
     train_ds = MisspelledDataset(corpus_dir=params.TRAIN_CORPUS_DIR,
                                  percent_err=params.PERCENT_NOISE,
                                  min_num_tokens=params.MIN_NUM_TOKENS)
+    collator = partial(custom_collator, static_padding=params.STATIC_PADDING)
     train_loader = DataLoader(train_ds,
                               batch_size=params.BATCH_SIZE,
-                              collate_fn=custom_collator,
-                              num_workers=params.NUM_WORKER,
-                              drop_last=True)
+                              collate_fn=collator,
+                              drop_last=True,
+                              **loader_kwargs)
 
     # This validation dataset is inconsistent between epoch,
     # since we randomly select a sentence, add noise and chunk
@@ -190,9 +198,9 @@ def main():
                                min_num_tokens=params.MIN_NUM_TOKENS)
     val_loader = DataLoader(val_ds,
                             batch_size=params.BATCH_SIZE,
-                            collate_fn=custom_collator,
-                            num_workers=params.NUM_WORKER,
-                            drop_last=False)
+                            collate_fn=collator,
+                            drop_last=False,
+                            **loader_kwargs)
 
     char_cfg = AlbertConfig().from_json_file("spell_model/char_model/config.json")
     word_cfg = AlbertConfig().from_json_file("spell_model/word_model/config.json")
@@ -1,5 +1,4 @@
 import torch
-from torch import nn
 from torch.nn import functional as F
 from fvcore.nn.focal_loss import sigmoid_focal_loss
 
@@ -39,8 +38,8 @@ def compute_detection_loss(
     # Temporary fix the hyperparameter here
     # loss = sigmoid_focal_loss(_det_logits, _det_labels, alpha=-1, gamma=2, reduction="mean")
 
-    criteria = nn.BCEWithLogitsLoss(pos_weight=torch.Tensor([2]).to(_det_labels.device))
-    loss = criteria(_det_logits, _det_labels.float())
+    loss = F.binary_cross_entropy_with_logits(_det_logits, _det_labels.float(),
+                                              pos_weight=_det_logits.new_full((1,), 2.))
 
     # Normalize the loss based on length of the sequence
     # (Follow the paper but not sure if this has any effect)
@@ -67,23 +66,22 @@ def compute_correct_loss(
     Returns:
         loss
     """
-    criteria = nn.CrossEntropyLoss()
     num_classes = correction_logits.size(2)
 
     _corr_logits = correction_logits.view(-1, num_classes)
     _det_labels = detection_labels.view(-1)
     _corr_labels = correction_labels.view(-1)
 
-    valid_indexes = torch.where(_det_labels > 0)[0]
+    error_mask = _det_labels > 0
 
     # Case correct batches, return 0
-    if valid_indexes.size(0) == 0:
+    if not error_mask.any():
         return 0
 
-    _corr_logits = torch.index_select(_corr_logits, 0, valid_indexes)
-    _corr_labels = torch.index_select(_corr_labels, 0, valid_indexes)
+    # Ignore correct tokens instead of gathering the error ones (no nonzero() and index_select)
+    _corr_labels = _corr_labels.masked_fill(~error_mask, -100)
 
-    loss = criteria(_corr_logits, _corr_labels)
+    loss = F.cross_entropy(_corr_logits, _corr_labels, ignore_index=-100)
     return loss
 
 
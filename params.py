@@ -13,6 +13,9 @@ class Param:
     MIN_NUM_TOKENS: int = 5
     BATCH_SIZE: int = 8
     NUM_WORKER: int = 8
+    # Pad every batch to the maximum number of words/chars (fixed shapes) instead of the longest in batch,
+    # only worth it with a compiled or CUDA graph captured model
+    STATIC_PADDING: bool = False
 
     # Training
 
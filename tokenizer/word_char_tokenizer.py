@@ -12,7 +12,13 @@ from tokenizers.pre_tokenizers import WhitespaceSplit
 from tokenizers.processors import TemplateProcessing
 from nltk.tokenize import wordpunct_tokenize
 
-from utils.common import SpecialTokens, all_special_tokens
+from utils.common import SpecialTokens, special_token_set
+
+whitespace_pattern = re.compile(r"\s+")
+# The word_tokenize func changes " into `` and '' by default
+quote_map = {"``": '"', "''": '"', '”': '"', '“': '"'}
+# Chars dropped by PreCharTokenizer
+char_drop_table = str.maketrans('', '', ' ”“')
 
 
 class AbsPreTokenizer(metaclass=ABCMeta):
@@ -31,15 +37,9 @@ class PreWordTokenizer(AbsPreTokenizer):
         sequence = sequence.strip()
         sequence = self.normalizer.normalize_str(sequence)
 
-        # The word_tokenize func changes " into `` and '' by default
-        tokens = wordpunct_tokenize(sequence)
-        for i in range(len(tokens)):
-            if tokens[i] == "``" or tokens[i] == "''" or \
-                    tokens[i] == '”' or tokens[i] == '“':
-                tokens[i] = '"'
-            # Make sure token does not contain any whitespace
-            tokens[i] = re.sub(r"\s+", '', tokens[i])
-        return tokens
+        # Normalize quotes, and make sure token does not contain any whitespace
+        return [whitespace_pattern.sub('', quote_map.get(token, token))
+                for token in wordpunct_tokenize(sequence)]
 
 
 class PreCharTokenizer(AbsPreTokenizer):
@@ -52,12 +52,10 @@ class PreCharTokenizer(AbsPreTokenizer):
         sequence = sequence.strip()
         sequence = self.normalizer.normalize_str(sequence)
 
-        if sequence in all_special_tokens:
+        if sequence in special_token_set:
             return [sequence]
 
-        tokens = [c for c in sequence
-                  if c != ' ' and c != '”' and c != '“']
-        return tokens
+        return list(sequence.translate(char_drop_table))
 
 
 def read_file_generator(corpus_path: str, pre_tokenizer: AbsPreTokenizer):
@@ -1,8 +1,8 @@
 import random
+import re
 from typing import List
 
 import numpy as np
-import regex
 import unidecode
 from nltk.tokenize import word_tokenize
 import string
@@ -11,11 +11,17 @@ import string
 # import nltk
 # nltk.download('punkt')
 
-non_vocab_pattern = regex.compile(r"""[^aAàÀảẢãÃáÁạẠăĂằẰẳẲẵẴắẮặẶâÂầẦẩẨẫẪấẤậẬbBcCdDđĐeEèÈẻẺẽẼéÉẹẸêÊềỀểỂễỄếẾệỆfFgGhHiIìÌỉỈĩĨíÍịỊjJkKlLmMnNoOòÒỏỎõÕóÓọỌôÔồỒổỔỗỖốỐộỘơƠờỜởỞỡỠớỚợỢpPqQrRsStTuUùÙủỦũŨúÚụỤưƯừỪửỬữỮứỨựỰvVwWxXyYỳỲỷỶỹỸýÝỵỴzZ0123456789!"#$%&'()*+,-./:;<=>?@[\]^_`{|}~[:space:]]""")
+vn_letters = "aAàÀảẢãÃáÁạẠăĂằẰẳẲẵẴắẮặẶâÂầẦẩẨẫẪấẤậẬbBcCdDđĐeEèÈẻẺẽẼéÉẹẸêÊềỀểỂễỄếẾệỆfFgGhHiIìÌỉỈĩĨíÍịỊjJkKlLmMnNoOòÒỏỎõÕóÓọỌôÔồỒổỔỗỖốỐộỘơƠờỜởỞỡỠớỚợỢpPqQrRsStTuUùÙủỦũŨúÚụỤưƯừỪửỬữỮứỨựỰvVwWxXyYỳỲỷỶỹỸýÝỵỴzZ"
+# Same characters as the [:space:] class of the (third-party) regex module
+space_chars = "\t\n\x0b\x0c\r \x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a" \
+              "\u2028\u2029\u202f\u205f\u3000"
+# Vietnamese letters, punctuation (without backslash) and spaces, digits are excluded on purpose
+latin_chars = frozenset(vn_letters + string.punctuation.replace('\\', '') + space_chars)
 
 
 def has_numbers_or_non_latin(text):
-    return bool(regex.search(r'\d', text)) or bool(non_vocab_pattern.search(text))
+    # Set lookup per char in C, instead of two regex scans
+    return not latin_chars.issuperset(text)
 
 
 class Synthesizer(object):
@@ -312,7 +318,8 @@ class Synthesizer(object):
         candidates = []
         for i in range(len(text)):
             for char in self.all_char_candidates:
-                if regex.search(char, text[i]) is not None:
+                # Candidates are plain letters, a substring test is enough
+                if char in text[i]:
                     candidates.append((i, char))
                     break
 
@@ -328,7 +335,7 @@ class Synthesizer(object):
                     return False, text, label
 
             replaced = self.replace_char_candidate(candidates[idx][1])
-            text[candidates[idx][0]] = regex.sub(candidates[idx][1], replaced, text[candidates[idx][0]])
+            text[candidates[idx][0]] = text[candidates[idx][0]].replace(candidates[idx][1], replaced)
 
             label[candidates[idx][0]] = 1
             return True, text, label
@@ -425,21 +432,21 @@ class Synthesizer(object):
             chosen_letter = text[idx][np.random.randint(0, len(text[idx]))]
             replaced = self.vn_alphabet[np.random.randint(0, self.alphabet_len)]
             try:
-                text[idx] = regex.sub(chosen_letter, replaced, text[idx])
+                text[idx] = re.sub(chosen_letter, replaced, text[idx])
             except:
                 return False, text, label
         elif coin == 1:
             chosen_letter = text[idx][np.random.randint(0, len(text[idx]))]
             replaced = chosen_letter + self.vn_alphabet[np.random.randint(0, self.alphabet_len)]
             try:
-                text[idx] = regex.sub(chosen_letter, replaced, text[idx])
+                text[idx] = re.sub(chosen_letter, replaced, text[idx])
             except:
                 return False, text, label
         else:
             chosen_letter = text[idx][np.random.randint(0, len(text[idx]))]
             try:
                 # Case string contains repeated word -> need count = 1
-                text[idx] = regex.sub(chosen_letter, '', text[idx], count=1)
+                text[idx] = re.sub(chosen_letter, '', text[idx], count=1)
             except:
                 return False, text, label
 
@@ -13,6 +13,8 @@ class SpecialTokens:
 
 
 all_special_tokens = [SpecialTokens.pad, SpecialTokens.unk, SpecialTokens.cls, SpecialTokens.sep]
+# For O(1) membership tests in per-word loops
+special_token_set = frozenset(all_special_tokens)
 
 
 def tokenize_with_span(text):
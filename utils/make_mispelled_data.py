@@ -2,11 +2,13 @@
 This script is used to make diacritic errors, ngọng
 """
 
+import math
 import random
-import numpy as np
 import re
+import sys
+import numpy as np
 import string
-import locale
+from multiprocessing import Pool
 from underthesea import sent_tokenize, word_tokenize
 
 # Constants
@@ -18,36 +20,88 @@ s0 = u'AAAAEEEIIOOOOUUYaaaaeeeiioooouuyAaDdIiUuOoUuAaAaAaAaAaAaAaAaAaAaAaAa' \
 s3 = u'ẤấẦầẨẩẪẫẬậẮắẰằẲẳẴẵẶặẾếỀềỂểỄễỆệỐốỒồỔổỖỗỘộỚớỜờỞởỠỡỢợỨứỪừỬửỮữỰự'
 s2 = u'ÂâÂâÂâÂâÂâĂăĂăĂăĂăĂăÊêÊêÊêÊêÊêÔôÔôÔôÔôÔôƠơƠơƠơƠơƠơƯưƯưƯưƯưƯư'
 alphabet = u'abcdefghijklmnopqrstuvwxyz'
+punctuation_set = frozenset(string.punctuation)
+number_start_chars = frozenset('0123456789.,+-')
+
+# Interned tags so the millions of returned tuples share the same string objects
+pos_correct = sys.intern("C")
+pos_typo = sys.intern("TYPO")
+no_typo = sys.intern("None")
+typo_types = {name: sys.intern(name) for name in [
+    "Special tone swap", "Remove accent", "Swap char", "Remove char", "Add char",
+    "Ngong l-n", "Ngong n-l", "Ngong s-x", "Ngong x-s", "Ngong tr-ch", "Ngong ch-tr",
+    "Ngong gi-d", "Ngong d-gi", "Ngong r-d", "Ngong d-r",
+]}
+
+# bound once, the typo generator draws up to ~25 gates per token
+random_float = random.random
+
+# Precomputed lookups for accent removal
+s1_to_s0 = dict(zip(s1, s0))
+s3_to_s2 = dict(zip(s3, s2))
+accent_table = str.maketrans(s1_to_s0)
+# s3 -> s2 with p=0.7 then s1 -> s0 with p=0.5, fused into one draw per char (s2 and s3 are subsets of s1):
+# stripped with p=0.5, partially stripped (s2) with p=0.35, unchanged otherwise
+accent_variants = {c: (s1_to_s0[c], s3_to_s2.get(c, c)) for c in s1}
+# codepoint lookup table over the BMP for stripping accents from whole documents
+accent_lut = np.arange(0x10000, dtype=np.uint32)
+accent_lut[[ord(c) for c in s1]] = [ord(c) for c in s0]
 
 s5 = ['úy', 'ùy', 'ủy', 'ũy', 'ụy', 'óa', 'òa', 'ỏa', 'õa', 'ọa']
 s4 = ['uý', 'uỳ', 'uỷ', 'uỹ', 'uỵ', 'oá', 'oà', 'oả', 'oã', 'oạ']
+special_tone_map = dict(zip(s5, s4))
+special_tone_pattern = re.compile("|".join(s5))
 
 vowels = ['a', 'á', 'à', 'ả', 'ạ', 'ă', 'ắ', 'ằ', 'ẳ', 'ặ', 'â', 'ấ', 'ầ', 'ẩ', 'ậ',
           'e', 'é', 'è', 'ẻ', 'ẹ', 'ê', 'ế', 'ề', 'ể', 'ệ', 'i', 'í', 'ì', 'ỉ', 'ị',
           'o', 'ó', 'ò', 'ỏ', 'ọ', 'ô', 'ố', 'ồ', 'ổ', 'ộ', 'ơ', 'ớ', 'ờ', 'ở', 'ợ',
           'u', 'ú', 'ù', 'ủ', 'ụ', 'ư', 'ứ', 'ừ', 'ử', 'ự', 'y', 'ý', 'ỳ', 'ỷ', 'ỵ']
+vowel_set = frozenset(vowels)
+
+hyperlink_pattern = re.compile(">>.+>>")  # remove hyperlinks between ">>"
+# '\dh' also covers hours with minutes ('\dh\d{2}')
+time_or_measurement_pattern = re.compile(r'\dh|\dm\d')
+
+# Ngong rules keyed by prefix: (replacement, replaced length, min token length, typo type), tried in order
+ngong_rules = {
+    'l': [('n', 1, 2, typo_types["Ngong l-n"])],
+    'L': [('N', 1, 2, typo_types["Ngong l-n"])],
+    'n': [('l', 1, 2, typo_types["Ngong n-l"])],
+    'N': [('L', 1, 2, typo_types["Ngong n-l"])],
+    's': [('x', 1, 2, typo_types["Ngong s-x"])],
+    'S': [('X', 1, 2, typo_types["Ngong s-x"])],
+    'x': [('s', 1, 2, typo_types["Ngong x-s"])],
+    'X': [('S', 1, 2, typo_types["Ngong x-s"])],
+    'tr': [('ch', 2, 3, typo_types["Ngong tr-ch"])],
+    'Tr': [('Ch', 2, 3, typo_types["Ngong tr-ch"])],
+    'ch': [('tr', 2, 3, typo_types["Ngong ch-tr"])],
+    'Ch': [('Tr', 2, 3, typo_types["Ngong ch-tr"])],
+    'gi': [('d', 2, 3, typo_types["Ngong gi-d"])],
+    'Gi': [('D', 2, 3, typo_types["Ngong gi-d"])],
+    'd': [('gi', 2, 2, typo_types["Ngong d-gi"]), ('r', 1, 2, typo_types["Ngong d-r"])],
+    'D': [('Gi', 2, 3, typo_types["Ngong d-gi"]), ('R', 1, 2, typo_types["Ngong d-r"])],
+    'r': [('d', 1, 2, typo_types["Ngong r-d"])],
+    'R': [('D', 1, 2, typo_types["Ngong r-d"])],
+}
 
 
 def remove_accents(input_str):
-    s = ''
-    for c in input_str:
-        if c in s1:
-            s += s0[s1.index(c)]
-        else:
-            s += c
-    return s
+    return input_str.translate(accent_table)
+
+
+# same as remove_accents but vectorized over codepoints, faster on large texts (e.g. whole articles)
+def strip_accents_bulk(text):
+    codepoints = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).copy()
+    in_bmp = codepoints < 0x10000
+    codepoints[in_bmp] = accent_lut[codepoints[in_bmp]]
+    return codepoints.tobytes().decode('utf-32-le')
 
 
 def remove_special_char(input_article):
     # annotator = VnCoreNLP(address="http://127.0.0.1", port=9000) 
-    pattern = ">>.+>>"  # remove hyperlinks between ">>"
-
     sentences = sent_tokenize(input_article)  # sentence tokenize
-    for i in range(len(sentences)):
-        sentences[i] = re.sub(pattern, "", sentences[i])
-        sentences[i] = sentences[i].replace(".. ", ". ")
-    sentences = [" ".join(word_tokenize(sent)) for sent in sentences]
-    return sentences
+    # hyperlinks go first, their removal can leave a ".. " behind
+    return [" ".join(word_tokenize(hyperlink_pattern.sub("", sent).replace(".. ", ". "))) for sent in sentences]
 
 
 def read_raw_text(input_file):
@@ -62,11 +116,14 @@ def read_keywords_file(keywords_file):
     return keywords
 
 
+# keep articles containing any of the keywords, scanning each article once with a single alternation
 def find_articles_by_keyword(articles, keywords):
-    articles_by_keywords = []
-    for article in articles:
-        if article.find(keywords):
-            pass
+    keywords = [keyword.strip() for keyword in keywords]
+    keywords = [keyword for keyword in keywords if keyword]
+    if not keywords:
+        return []
+    keyword_pattern = re.compile("|".join(map(re.escape, keywords)))
+    return [article for article in articles if keyword_pattern.search(article)]
 
 
 # original typo generation function - not use anymore
@@ -132,13 +189,17 @@ def find_articles_by_keyword(articles, keywords):
 
 # check if a token is number or not (e.g. 15.20 or 15,20)
 def is_number(text):
+    # most tokens are words, skip the exceptions raised by float()/int() for them
+    if not text or text[0] not in number_start_chars:
+        return False
     try:
         float(text)
         return True
     except ValueError:
         pass
     try:
-        locale.atoi(text)
+        # comma as thousands separator (what locale.atoi accepted under en_US.UTF-8)
+        int(text.replace(',', ''))
         return True
     except ValueError:
         pass
@@ -147,27 +208,29 @@ def is_number(text):
 
 # check if a token is hour or measurement (e.g. 15h20, 3h, 1m55)
 def is_time_or_measurement(text):
-    time_pattern = r'\dh\d{2}'
-    time_pattern2 = r'\dh'
-    measurement_pattern = r'\dm\d'
-    time_search = re.search(time_pattern, text)
-    time_search2 = re.search(time_pattern2, text)
-    measurement_search = re.search(measurement_pattern, text)
-    return time_search or time_search2 or measurement_search
+    return time_or_measurement_pattern.search(text) is not None
 
 
-# check if a token include 'uy' or 'oa'
+# check if a token include 'uy' or 'oa' (not at the start), returns the match or None
 def special_tone_contain(text):
-    for i in range(len(s5)):
-        if text.find(s5[i]) > 0:
-            return i
-    return False
+    return special_tone_pattern.search(text, 1)
 
 
 def manual_replace(s, char, index, length):
     return s[:index] + char + s[index + length:]
 
 
+# draw from Poisson(lam) with Knuth's method, cheap for the small rates used here
+def sample_poisson(lam):
+    limit = math.exp(-lam)
+    k = 0
+    p = random_float()
+    while p > limit:
+        k += 1
+        p *= random_float()
+    return k
+
+
 # main function
 def generate_typos_and_pos(token,
                            no_typo_prob=0.6,
@@ -177,188 +240,118 @@ def generate_typos_and_pos(token,
                            swap_char_prob=0.1,
                            add_chars_prob=0.2,
                            remove_chars_prob=0.2):
-
-    locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
-
-    pos = "C"
-    typo_type = "None"
-    if is_number(token) or is_time_or_measurement(token) or token in string.punctuation:  # skip typo on digit
+    pos = pos_correct
+    typo_type = no_typo
+    # skip typo on digit and punctuation
+    if is_number(token) or is_time_or_measurement(token) or punctuation_set.issuperset(token):
         return token, pos, typo_type
-    if random.random() < no_typo_prob:
+    if random_float() < no_typo_prob:
         # print("No typo prob")
         return token, pos, typo_type
     # Tha dau "oa", "uy"
-    if special_tone_contain(token) and random.random() < special_tone_prob:
-        special_tone_index = special_tone_contain(token)
-        token = token.replace(s5[special_tone_index], s4[special_tone_index])
-        pos = "TYPO"
-        typo_type = "Special tone swap"
+    special_tone = special_tone_contain(token)
+    if special_tone and random_float() < special_tone_prob:
+        token = manual_replace(token, special_tone_map[special_tone.group()], special_tone.start(), 2)
+        pos = pos_typo
+        typo_type = typo_types["Special tone swap"]
         return token, pos, typo_type
     # Tha dau "oa", "uy"
 
-    # Ngong l-n
-    if token.startswith('l') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'n', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong l-n"
-        return token, pos, typo_type
-    if token.startswith('L') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'N', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong l-n"
-        return token, pos, typo_type
-    # Ngong n-l
-    if token.startswith('n') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'l', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong n-l"
-        return token, pos, typo_type
-    if token.startswith('N') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'L', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong n-l"
-        return token, pos, typo_type
-    # Ngong s-x
-    if token.startswith('s') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'x', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong s-x"
-        return token, pos, typo_type
-    if token.startswith('S') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'X', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong s-x"
-        return token, pos, typo_type
-    # Ngong x-s
-    if token.startswith('x') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 's', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong x-s"
-        return token, pos, typo_type
-    if token.startswith('X') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'S', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong x-s"
-        return token, pos, typo_type
-    # Ngong tr-ch
-    if token.startswith('tr') and len(token) > 3 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'ch', 0, 2)
-        pos = "TYPO"
-        typo_type = "Ngong tr-ch"
-        return token, pos, typo_type
-    if token.startswith('Tr') and len(token) > 3 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'Ch', 0, 2)
-        pos = "TYPO"
-        typo_type = "Ngong tr-ch"
-        return token, pos, typo_type
-    # Ngong ch-tr
-    if token.startswith('ch') and len(token) > 3 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'tr', 0, 2)
-        pos = "TYPO"
-        typo_type = "Ngong ch-tr"
-        return token, pos, typo_type
-    if token.startswith('Ch') and len(token) > 3 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'Tr', 0, 2)
-        pos = "TYPO"
-        typo_type = "Ngong ch-tr"
-        return token, pos, typo_type
-    # Ngong gi-d
-    if token.startswith('gi') and len(token) > 3 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'd', 0, 2)
-        pos = "TYPO"
-        typo_type = "Ngong gi-d"
-        return token, pos, typo_type
-    if token.startswith('Gi') and len(token) > 3 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'D', 0, 2)
-        pos = "TYPO"
-        typo_type = "Ngong gi-d"
-        return token, pos, typo_type
-    # Ngong d-gi
-    if token.startswith('d') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'gi', 0, 2)
-        pos = "TYPO"
-        typo_type = "Ngong d-gi"
-        return token, pos, typo_type
-    if token.startswith('D') and len(token) > 3 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'Gi', 0, 2)
-        pos = "TYPO"
-        typo_type = "Ngong d-gi"
-        return token, pos, typo_type
-    # Ngong r-d
-    if token.startswith('r') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'd', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong r-d"
-        return token, pos, typo_type
-    if token.startswith('R') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'D', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong r-d"
-        return token, pos, typo_type
-    # Ngong d-r
-    if token.startswith('d') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'r', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong d-r"
-        return token, pos, typo_type
-    if token.startswith('D') and len(token) > 2 and token[1] in vowels and random.random() < ngong_typo_prob:
-        token = manual_replace(token, 'R', 0, 1)
-        pos = "TYPO"
-        typo_type = "Ngong d-r"
-        return token, pos, typo_type
-    # Bo dau
-    if random.random() < accents_prob:
-        if random.random() < 0.5:
+    # Ngong
+    rules = ngong_rules.get(token[:2]) or ngong_rules.get(token[:1], ())
+    for replacement, length, min_len, ngong_type in rules:
+        if len(token) > min_len and token[1] in vowel_set and random_float() < ngong_typo_prob:
+            token = manual_replace(token, replacement, 0, length)
+            pos = pos_typo
+            typo_type = ngong_type
+            return token, pos, typo_type
+    # Bo dau, tokens without accented chars (s3 and s2 are subsets of s1) are left as is
+    if random_float() < accents_prob and not s1_to_s0.keys().isdisjoint(token):
+        if random_float() < 0.5:
             # print("accents_prob < 0.5")
             new_token = remove_accents(token)
         else:
             # print("accents_prob >= 0.5")
             new_chars = []
             for cc in token:
-                if cc in s3 and random.random() < 0.7:
-                    cc = s2[s3.index(cc)]
-                if cc in s1 and random.random() < 0.5:
-                    cc = s0[s1.index(cc)]
+                variants = accent_variants.get(cc)
+                if variants:
+                    r = random_float()
+                    if r < 0.5:
+                        cc = variants[0]
+                    elif r < 0.85:
+                        cc = variants[1]
                 new_chars.append(cc)
             new_token = "".join(new_chars)
 
         if new_token != token:
-            pos = "TYPO"
-            typo_type = "Remove accent"
+            pos = pos_typo
+            typo_type = typo_types["Remove accent"]
             token = new_token
 
-    if random.random() < swap_char_prob:
+    if random_float() < swap_char_prob:
         # print("swap_char_prob")
         chars = list(token)
-        n_swap = min(len(chars), np.random.poisson(0.5) + 1)
-        index = np.random.choice(
-            np.arange(len(chars)), size=n_swap, replace=False)
-        swap_index = index[np.random.permutation(index.shape[0])]
-        swap_dict = {ii: jj for ii, jj in zip(index, swap_index)}
-        chars = [chars[ii] if ii not in index else chars[swap_dict[ii]]
-                 for ii in range(len(chars))]
+        n_swap = min(len(chars), sample_poisson(0.5) + 1)
+        index = random.sample(range(len(chars)), n_swap)
+        picked = [chars[ii] for ii in index]
+        random.shuffle(picked)
+        for ii, cc in zip(index, picked):
+            chars[ii] = cc
         new_token = "".join(chars)
         if new_token != token:
             token = new_token
-            pos = "TYPO"
-            typo_type = "Swap char"
-    if random.random() < remove_chars_prob:
+            pos = pos_typo
+            typo_type = typo_types["Swap char"]
+    if random_float() < remove_chars_prob:
         # print("remove_chars_prob")
-        n_remove = min(len(token), np.random.poisson(0.005) + 1)
-        for _ in range(n_remove):
-            pos = np.random.choice(np.arange(len(token)), size=1)[0]
-            token = token[:pos] + token[pos + 1:]
-        pos = "TYPO"
-        typo_type = "Remove char"
-    if random.random() < add_chars_prob:
+        n_remove = min(len(token), sample_poisson(0.005) + 1)
+        chars = list(token)
+        for idx in sorted(random.sample(range(len(chars)), n_remove), reverse=True):
+            del chars[idx]
+        token = "".join(chars)
+        pos = pos_typo
+        typo_type = typo_types["Remove char"]
+    if random_float() < add_chars_prob:
         # print("add_chars_prob")
-        n_add = min(len(token), np.random.poisson(0.05) + 1)
-        adding_chars = np.random.choice(
-            list(alphabet), size=n_add, replace=True)
-        for cc in adding_chars:
-            pos = np.random.choice(np.arange(len(token)), size=1)[0]
-            token = "".join([token[:pos], cc, token[pos:]])
-        pos = "TYPO"
-        typo_type = "Add char"
+        n_add = min(len(token), sample_poisson(0.05) + 1)
+        adding_chars = random.choices(alphabet, k=n_add)
+        # the token grows by one char after each insertion
+        positions = [random.randrange(len(token) + i) for i in range(n_add)]
+        chars = list(token)
+        for idx, cc in zip(positions, adding_chars):
+            chars.insert(idx, cc)
+        token = "".join(chars)
+        pos = pos_typo
+        typo_type = typo_types["Add char"]
 
     return token, pos, typo_type
+
+
+# batched version of generate_typos_and_pos: the no-typo gate is drawn for all tokens at once
+# and only the remaining tokens go through the per-token generator
+def generate_typos_batch(tokens, no_typo_prob=0.6, **typo_probs):
+    has_typo = (np.random.random(len(tokens)) >= no_typo_prob).tolist()
+    results = []
+    for token, typo in zip(tokens, has_typo):
+        if typo:
+            results.append(generate_typos_and_pos(token, no_typo_prob=0., **typo_probs))
+        else:
+            results.append((token, pos_correct, no_typo))
+    return results
+
+
+def seed_worker():
+    # forked workers inherit the parent's RNG state, re-seed from OS entropy so they don't repeat typos
+    random.seed()
+    np.random.seed()
+
+
+def generate_typos_for_article(article):
+    return [generate_typos_batch(sentence.split()) for sentence in remove_special_char(article)]
+
+
+# generate typos for many articles in parallel, returns per article a list of sentences of (token, pos, typo_type)
+def generate_corpus(articles, n_workers=None, chunksize=256):
+    with Pool(n_workers, initializer=seed_worker) as pool:
+        return list(pool.imap(generate_typos_for_article, articles, chunksize=chunksize))